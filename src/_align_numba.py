@@ -0,0 +1,66 @@
+import numpy as np
+
+from ._numba import njit
+from ._cigar import DELETION  # 'p' represents a deletion and is treated as a wildcard
+
+
+@njit(cache=True, boundscheck=False)
+def nw_fill(query, ref, gap_penalty, traceback):
+    """Fills the Needleman-Wunsch scoring matrix of query against ref and returns its traceback matrix.
+
+    Matches (or any base against a deletion) score 1, mismatches 0 and gaps gap_penalty. The first row
+    and column are not penalized. Only the traceback is kept as a matrix, written into a preallocated buffer
+    so that it can be reused across the reads of a cluster; the scores live in a single row updated in place.
+
+    Args:
+        query (np.ndarray): uint8 array with the sequence to align.
+        ref (np.ndarray): uint8 array with the reference sequence.
+        gap_penalty (int): score of an insertion or deletion.
+        traceback (np.ndarray): int8 buffer of at least (len(query) + 1, len(ref) + 1) for the traceback matrix.
+
+    Returns:
+        np.ndarray: (len(query) + 1, len(ref) + 1) view of the traceback matrix (1: diagonal, 2: up, 3: left).
+    """
+    rows = query.shape[0] + 1
+    cols = ref.shape[0] + 1
+    traceback = traceback[:rows, :cols]
+
+    # the borders score 0 and can only be left through the first row (left) or the first column (up)
+    traceback[0, :] = 3
+    traceback[:, 0] = 2
+    row = np.zeros(cols, dtype=np.int32)
+
+    for r in range(1, rows):
+        # the query base is the same for the whole row, a deletion matches every column
+        base = query[r - 1]
+        base_is_deletion = base == DELETION
+
+        # row holds the previous row up to column c - 1 and the current one from c on, the diagonal and
+        # left neighbours are carried over in registers
+        diagonal_score = 0
+        left_score = 0
+        for c in range(1, cols):
+            ref_base = ref[c - 1]
+            up_score = row[c]
+            if base_is_deletion or base == ref_base or ref_base == DELETION:
+                diagonal = diagonal_score + 1
+            else:
+                diagonal = diagonal_score
+            up = up_score + gap_penalty
+            left = left_score + gap_penalty
+
+            if diagonal >= up and diagonal >= left:
+                best = diagonal
+                traceback[r, c] = 1
+            elif up >= left:
+                best = up
+                traceback[r, c] = 2
+            else:
+                best = left
+                traceback[r, c] = 3
+
+            row[c] = best
+            diagonal_score = up_score
+            left_score = best
+
+    return traceback
@@ -0,0 +1,90 @@
+import string
+
+import numpy as np
+
+from ._numba import njit, NUMBA_AVAILABLE
+
+# padded reads are uint8 (bases) and int8 (qualities) arrays, deletions are stored as 'p' in the sequence
+# and QUAL_DELETION in the qualities
+DELETION = ord("p")
+QUAL_DELETION = -1
+
+# insertions are lowercased: translate table for bytes and its uint8 lookup array for the kernel
+LOWERCASE = bytes.maketrans(string.ascii_uppercase.encode(), string.ascii_lowercase.encode())
+_LOWERCASE_CODES = np.frombuffer(LOWERCASE, dtype=np.uint8)
+
+
+@njit(cache=True, boundscheck=False)
+def apply_cigar(ops, lens, seq, qual, out_seq, out_qual):
+    """Pads a read following its CIGAR (see CustomAlignedSegment.pad).
+
+    Matches and mismatches are copied, insertions are lowercased and deletions are filled with DELETION
+    and QUAL_DELETION. The CIGAR only holds these three operations (see utils._normalize_cigar).
+
+    Args:
+        ops (np.ndarray): int32 array with the CIGAR operations.
+        lens (np.ndarray): int32 array with the length of each operation.
+        seq (np.ndarray): uint8 array with the bases of the read.
+        qual (np.ndarray): int8 array with the quality of each base.
+        out_seq (np.ndarray): preallocated uint8 array for the padded bases.
+        out_qual (np.ndarray): preallocated int8 array for the padded qualities.
+    """
+    pos = 0
+    out = 0
+    for i in range(ops.shape[0]):
+        op = ops[i]
+        length = lens[i]
+        if op == 0:  # match or mismatch
+            for k in range(length):
+                out_seq[out + k] = seq[pos + k]
+                out_qual[out + k] = qual[pos + k]
+            pos += length
+        elif op == 1:  # insertion
+            for k in range(length):
+                out_seq[out + k] = _LOWERCASE_CODES[seq[pos + k]]
+                out_qual[out + k] = qual[pos + k]
+            pos += length
+        else:  # deletion
+            for k in range(length):
+                out_seq[out + k] = DELETION
+                out_qual[out + k] = QUAL_DELETION
+        out += length
+
+
+@njit(cache=True, boundscheck=False)
+def apply_cigars(ops, lens, cigar_offsets, seqs, quals, offsets, out_seqs, out_quals, out_offsets):
+    """Pads a batch of reads packed one after the other (see apply_cigar). The operations, bases and padded
+    output of read i go from offsets[i] to offsets[i + 1] of their respective arrays.
+
+    Args:
+        ops (np.ndarray): int32 array with the CIGAR operations of all the reads.
+        lens (np.ndarray): int32 array with the length of each operation.
+        cigar_offsets (np.ndarray): int64 array with the (n_reads + 1) offsets of the CIGAR of each read.
+        seqs (np.ndarray): uint8 array with the bases of all the reads.
+        quals (np.ndarray): int8 array with the quality of each base.
+        offsets (np.ndarray): int64 array with the (n_reads + 1) offsets of the bases of each read.
+        out_seqs (np.ndarray): preallocated uint8 array for the padded bases.
+        out_quals (np.ndarray): preallocated int8 array for the padded qualities.
+        out_offsets (np.ndarray): int64 array with the (n_reads + 1) offsets of each padded read.
+    """
+    for i in range(cigar_offsets.shape[0] - 1):
+        cigar = slice(cigar_offsets[i], cigar_offsets[i + 1])
+        read = slice(offsets[i], offsets[i + 1])
+        out = slice(out_offsets[i], out_offsets[i + 1])
+        apply_cigar(ops[cigar], lens[cigar], seqs[read], quals[read], out_seqs[out], out_quals[out])
+
+
+if NUMBA_AVAILABLE:
+    # compile (or load from the cache) at import time, so that the first cluster does not pay for it
+    _one_read = np.array([0, 1], dtype=np.int64)
+    apply_cigars(
+        np.zeros(1, dtype=np.int32),
+        np.ones(1, dtype=np.int32),
+        _one_read,
+        np.frombuffer(b"A", dtype=np.uint8).copy(),
+        np.zeros(1, dtype=np.int8),
+        _one_read,
+        np.empty(1, dtype=np.uint8),
+        np.empty(1, dtype=np.int8),
+        _one_read,
+    )
@@ -1,58 +1,88 @@
 import logging
+from itertools import islice
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 
-# import Levenshtein
 import numpy as np
 from pysam import AlignmentFile, AlignedSegment
 from scipy.cluster import hierarchy
 
+from .utils import MP_CONTEXT, extract_umis, group_by_label, pack_umis, umi_distances
+
 logger = logging.getLogger(__name__)
 
 
+class _DisjointSet:
+    """Union-find over the integers 0..n-1, with union by rank and path halving."""
+
+    def __init__(self, n: int) -> None:
+        self.parents = list(range(n))
+        self.ranks = [0] * n
+
+    def find(self, i: int) -> int:
+        while self.parents[i] != i:
+            self.parents[i] = self.parents[self.parents[i]]
+            i = self.parents[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return
+        if self.ranks[i] < self.ranks[j]:
+            i, j = j, i
+        self.parents[j] = i
+        if self.ranks[i] == self.ranks[j]:
+            self.ranks[i] += 1
+
+
 class Clusterer:
-    def __init__(self, bam: str, regions: List) -> None:
+    def __init__(self, bam: str, regions: List, bam_threads: int = 1, umi_length: Optional[int] = None) -> None:
         self.bam = Path(bam)
+        self.bam_threads = bam_threads  # threads used by pysam to decompress the BAM
+        self.umi_length = umi_length  # if None, the UMI is the text after the last "_" of the read name
 
         self.regions = regions  # list of tuples (chr, start, end)
 
         self.UMIs = list()  # will hold an array of umis for each region
-        self.reads = list()  # will hold an array of reads for each region
+        self.reads = list()  # will hold an array of read names for each region
 
         if not self.bam.exists():
             logger.error(f"File {self.bam} not found.")
             quit(1)
 
-    def read_bam(self) -> Dict[str, List[AlignedSegment]]:
-        """Reads the bam file and returns the reads for each target region.
+    def read_bam(self) -> Dict[int, np.ndarray]:
+        """Reads the bam file and returns the names of the reads in each target region.
+        Only the read names are kept, so the AlignedSegments are freed as the file is streamed.
 
         Returns:
-            Dict[str, List[AlignedSegment]]: A dictionary with a list of reads for each target region.
+            Dict[int, np.ndarray]: A dictionary with an array of read names for each target region.
         """
         reads = dict()
 
         logger.info("Reading bam file...")
 
-        # Check if the bam file is paired-end or single-end
-        with AlignmentFile(self.bam, "rb") as bam:
-            sample = list(bam.fetch())[:1000]
+        with AlignmentFile(self.bam, "rb", threads=self.bam_threads) as bamfile:
+            # Check if the bam file is paired-end or single-end
+            sample = islice(bamfile.fetch(until_eof=True), 1000)
             counts = [read.is_paired for read in sample if not read.is_unmapped]
 
             if sum(counts) > 0:
                 logger.error(f"{self.bam} BAM file is paired-end, but only single-end is supported.")
                 quit(1)
-        
-        # Read the bam file
-        with AlignmentFile(self.bam, "rb") as bamfile:
+
+            # Read the bam file, extracting the read names and UMIs in the same pass
             for i, region in enumerate(self.regions):
                 logger.info(f"Fetching reads from {region[0]}:{region[1]}-{region[2]}")
-                reads[i] = [
-                    read for read in bamfile.fetch(*region) if not read.is_unmapped
-                ]
+                names = [read.query_name for read in bamfile.fetch(*region) if not read.is_unmapped]
+
+                reads[i] = np.asarray(names)
+                self.reads.append(reads[i])
+                self.UMIs.append(np.asarray(extract_umis(names, self.umi_length)))
 
         logger.info("Bam file parsed.")
 
-        if not reads[0]:
+        if not len(reads[0]):
             logger.error("No reads found.")
             quit(1)
 
@@ -63,67 +93,127 @@ class Clusterer:
 
         Args:
             UMIs (np.array[str]): numpy array containing the UMIs for each read.
-            reads (List[AlignedSegment]): numpy array containing the AlignedSegment objects.
+            reads (List): read names (or AlignedSegment objects) of the region.
             threshold (int, optional): humming-distance threshold to consider same origin. Defaults to 1.
 
         Returns:
-            dict[str, list]: dict containing the AlignedSegments for each cluster.
+            dict[str, list]: dict containing the reads for each cluster.
         """
-        clusters: Dict[str, List[AlignedSegment]] = dict()  # key: cluster id
-
         # create clusters of read indexes based on their UMI similarity
-        _clusters = self._run_clustering(UMIs, threshold)
+        return self._group_by_cluster(reads, _cluster_region(UMIs, threshold))
 
-        # fetch the reads associated with each UMI by index
-        for c in np.unique(_clusters):
-            assoc_reads: List = self._fetch_by_cluster_idx(reads, _clusters, c)
-            clusters[f"cluster_{c}"] = assoc_reads
+    def compute_all_clusters(self, threshold: int = 1, threads: int = 1) -> Dict[int, Dict]:
+        """Computes the clusters of every target region fetched by read_bam. The regions
+        are independent, so they are clustered in parallel and only the (cheap) grouping
+        of the reads is done in the parent process.
 
-            if not assoc_reads:
-                logger.warning(f"No reads found for cluster {c}.")
+        Args:
+            threshold (int, optional): humming-distance threshold to consider same origin. Defaults to 1.
+            threads (int, optional): number of processes to use. Defaults to 1.
 
-        return clusters
+        Returns:
+            Dict[int, dict]: dict containing the clusters (see compute_clusters) of each target region.
+        """
+        with MP_CONTEXT.Pool(processes=threads) as pool:
+            labels = pool.starmap(_cluster_region, [(umis, threshold) for umis in self.UMIs])
+
+        return {i: self._group_by_cluster(reads, l) for i, (reads, l) in enumerate(zip(self.reads, labels))}
+
+    @staticmethod
+    def _group_by_cluster(reads: List, _clusters: np.array) -> Dict[str, List]:
+        # fetch the reads associated with each cluster, key: cluster id
+        labels, grouped_reads = group_by_label(reads, _clusters)
+        return {f"cluster_{c}": assoc_reads for c, assoc_reads in zip(labels, grouped_reads)}
 
     @staticmethod
-    def get_UMIs(reads: List[AlignedSegment]) -> np.array:
-        return np.array([read.query_name.split("_")[-1] for read in reads])
+    def get_UMIs(reads: List[AlignedSegment], umi_length: Optional[int] = None) -> np.array:
+        return np.array(extract_umis([read.query_name for read in reads], umi_length))
 
     @staticmethod
     def get_read_ids(reads: List[AlignedSegment]) -> np.array:
         return np.array([read.query_name for read in reads])
 
-    # @staticmethod
-    # def _get_distances(umis: np.array) -> np.array:
-    #     return np.array(
-    #         [
-    #             Levenshtein.hamming(umis[i], umis[j])
-    #             for i in range(len(umis))
-    #             for j in range(len(umis))
-    #         ]
-    #     ).reshape(len(umis), len(umis))
+    @staticmethod
+    def _get_distances(umis: np.array) -> np.array:
+        """Computes the pairwise Hamming distances between equal-length UMIs.
+
+        The UMIs are bit-packed once and the condensed matrix (as expected by linkage)
+        is filled one row at a time, without ever building the N x N matrix.
+
+        Args:
+            umis (np.array[str]): numpy array containing the UMIs for each read.
+
+        Returns:
+            np.array: condensed distance matrix of length N * (N - 1) / 2.
+        """
+        packed = pack_umis(umis.tolist())
+        n = len(umis)
+
+        distances = np.empty(n * (n - 1) // 2, dtype=np.float64)
+        offset = 0
+        for i in range(n - 1):
+            distances[offset : offset + n - i - 1] = umi_distances(packed[i + 1 :], packed[i])
+            offset += n - i - 1
+
+        return distances
 
     @staticmethod
-    def _fetch_by_cluster_idx(reads: List, clusters: np.array, idx: int) -> List:
-        reads = np.array(reads)
-        return reads[clusters == idx].tolist()
-
-    def _run_clustering(self, umis: np.array, threshold: int = 1) -> np.array:
-        # Compute the Levenshtein distance matrix
-        dist_matrix = self._get_distances(umis)
-        if not dist_matrix.any():
-            logger.warning("No distances computed. Skipping clustering.")
-            return None
-
-        # Convert distance matrix to condensed form
-        distance_condensed = hierarchy.distance.squareform(dist_matrix)
-
-        # Perform hierarchical clustering with complete linkage
-        z = hierarchy.linkage(distance_condensed, method="complete")
-
-        # Extract clusters from the dendrogram
-        clusters = hierarchy.fcluster(z, t=threshold, criterion="distance")
-        if not clusters.any():
-            logger.warning("No clusters found. Skipping clustering.")
-            return None
-
-        return clusters
+    def _cluster_by_neighbors(umis: np.array, threshold: int = 1) -> np.array:
+        """Clusters the UMIs as the connected components of the graph that links every
+        pair of UMIs within the threshold. Only thresholds of 0 and 1 are supported: the
+        edges are found by looking up the 1-substitution neighbors of each UMI, which
+        takes O(N * L * |alphabet|) instead of the O(N^2) distance matrix.
+
+        Args:
+            umis (np.array[str]): numpy array containing the UMIs for each read.
+            threshold (int, optional): humming-distance threshold to consider same origin. Defaults to 1.
+
+        Returns:
+            np.array: cluster label (starting at 1) for each UMI.
+        """
+        components = _DisjointSet(len(umis))
+
+        # identical UMIs are always linked to the first read carrying them
+        index: Dict[str, int] = dict()
+        for i, umi in enumerate(umis):
+            components.union(i, index.setdefault(umi, i))
+
+        if threshold == 1:
+            alphabet = set("".join(index))
+            for umi, i in index.items():
+                for pos, base in enumerate(umi):
+                    for sub in alphabet - {base}:
+                        neighbor = index.get(umi[:pos] + sub + umi[pos + 1 :])
+                        if neighbor is not None:
+                            components.union(i, neighbor)
+
+        roots = [components.find(i) for i in range(len(umis))]
+        return np.unique(roots, return_inverse=True)[1] + 1
+
+
+def _cluster_region(umis: np.array, threshold: int = 1) -> np.array:
+    """Computes the cluster label of each UMI of a target region. Kept at module level so
+    that it can be sent to worker processes."""
+    # only the unique UMIs are clustered, their labels are then expanded back to each read
+    unique_umis, inverse = np.unique(umis, return_inverse=True)
+    if len(unique_umis) <= 1:
+        return np.ones(len(umis), dtype=int)
+
+    return _cluster_umis(unique_umis, threshold)[inverse]
+
+
+def _cluster_umis(umis: np.array, threshold: int = 1) -> np.array:
+    if threshold <= 1:
+        return Clusterer._cluster_by_neighbors(umis, threshold)
+
+    # Compute the condensed Hamming distance matrix
+    distance_condensed = Clusterer._get_distances(umis)
+    if not distance_condensed.any():
+        logger.warning("No distances computed. Assigning all the UMIs to the same cluster.")
+        return np.ones(len(umis), dtype=int)
+
+    # Perform hierarchical clustering with complete linkage
+    z = hierarchy.linkage(distance_condensed, method="complete")
+
+    # Extract clusters from the dendrogram (fcluster labels start at 1)
+    return hierarchy.fcluster(z, t=threshold, criterion="distance")
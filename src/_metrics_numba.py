@@ -0,0 +1,32 @@
+from ._numba import njit, prange
+
+
+@njit(inline="always")
+def _pair_distance(umi_dist, starts, ends, chroms, i, j, threshold, window):
+    coord_dist = (abs(starts[i] - starts[j]) + abs(ends[i] - ends[j])) / 2
+    if umi_dist <= threshold and chroms[i] == chroms[j] and coord_dist <= window:
+        return umi_dist + coord_dist
+    return 999.0
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def pairwise_umi_coord(umis, starts, ends, chroms, threshold, window, out):
+    """Fills out with the condensed distance matrix of the reads (see Clusterer._generate_matrix).
+
+    Args:
+        umis (np.ndarray): (N, L) uint8 matrix with the UMI of each read.
+        starts (np.ndarray): start coordinate of each read.
+        ends (np.ndarray): end coordinate of each read.
+        chroms (np.ndarray): integer id of the chromosome of each read.
+        threshold (int): maximum UMI distance to consider same cluster.
+        window (int): window size to consider for the coordinates.
+        out (np.ndarray): preallocated (float64) condensed matrix of length N * (N - 1) / 2.
+    """
+    n, umi_length = umis.shape
+    for i in prange(n - 1):
+        offset = i * n - i * (i + 1) // 2 - i - 1
+        for j in range(i + 1, n):
+            umi_dist = 0
+            for k in range(umi_length):
+                umi_dist += umis[i, k] != umis[j, k]
+            out[offset + j] = _pair_distance(umi_dist, starts, ends, chroms, i, j, threshold, window)
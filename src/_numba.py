@@ -0,0 +1,17 @@
+# numba is an optional dependency: when it is not installed, njit leaves the
+# decorated functions untouched, prange falls back to range and set_num_threads does nothing.
+try:
+    from numba import njit, prange, set_num_threads
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def set_num_threads(n):
+        pass
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
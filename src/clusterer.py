@@ -1,13 +1,17 @@
 import logging
 
+from itertools import islice
 from pathlib import Path
-from typing import List, Union, TypeVar
+from typing import Dict, List, Optional, Tuple, Union, TypeVar
 
 import numpy as np
 
 from pysam import AlignmentFile
 from scipy.cluster.hierarchy import linkage, fcluster
-from scipy.spatial.distance import pdist, hamming
+
+from ._numba import NUMBA_AVAILABLE
+from ._metrics_numba import pairwise_umi_coord
+from .utils import encode_umis, extract_umis, group_by_label, pack_umis, umi_distances
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +19,10 @@ AlignedSegment = TypeVar("AlignedSegment")
 
 
 class Clusterer:
-    def __init__(self, bam: str) -> None:
+    def __init__(self, bam: str, bam_threads: int = 1, umi_length: Optional[int] = None) -> None:
         self.bam = Path(bam)
+        self.bam_threads = bam_threads  # threads used by pysam to decompress the BAM
+        self.umi_length = umi_length  # if None, the UMI is the text after the last "_" of the read name
 
         if not self.bam.exists():
             logger.error(f"File {self.bam} not found.")
@@ -30,22 +36,22 @@ class Clusterer:
         """
         logger.info("Reading bam file...")
 
-        # Check if the bam file is paired-end or single-end
-        with AlignmentFile(self.bam, "rb") as bam:
-            sample = list(bam.fetch())[:1000]
+        with AlignmentFile(self.bam, "rb", threads=self.bam_threads) as bam:
+            # Check if the bam file is paired-end or single-end
+            sample = islice(bam.fetch(until_eof=True), 1000)
             counts = [read.is_paired for read in sample if not read.is_unmapped]
 
             if sum(counts) > 0:
                 logger.error(f"{self.bam} BAM file is paired-end, but only single-end is supported.")
                 raise ValueError(f"{self.bam} BAM file is paired-end, but only single-end is supported.")
 
-        # Read the bam file
-        logger.info("Fetching reads...")
-        if threads > 1:
-            reads = self._split_bam(self.bam)
-        else:
-            with AlignmentFile(self.bam, "rb") as bam:
-                reads = [read for read in bam.fetch() if not read.is_unmapped]
+            # Read the bam file in a single sequential pass, instead of seeking through the index
+            logger.info("Fetching reads...")
+            bam.reset()
+            if threads > 1:
+                reads = self._split_bam(bam)
+            else:
+                reads = [read for read in bam.fetch(until_eof=True) if not read.is_unmapped]
         logger.info("Bam file parsed.")
         
         if not any(reads):
@@ -65,19 +71,31 @@ class Clusterer:
         Returns:
             List[List[AlignedSegment]]: list of lists containing the reads for each cluster.
         """
-        # Compute the distance matrix based on the UMI distance and genomic coordinates
         if not reads:
             logger.warning("No reads found. Skipping clustering.")
             return []
         if len(reads) == 1:
             logger.warning(f"Skipping clustering. Only one read found in contig {reads[0].reference_name}.")
-            return reads
-        
-        distance_matrix = self._generate_matrix(reads, threshold, window)
+            return [reads]
+
+        # Group the reads sharing the exact same UMI and coordinates, only the unique keys are clustered.
+        # Linkage then sees each key once, so ties between equally distant merges may break differently
+        # than when clustering every read (a read equidistant to two groups can join the other one)
+        umis = extract_umis([read.query_name for read in reads], self.umi_length)
+        buckets: Dict[Tuple, List[int]] = dict()
+        for i, (umi, read) in enumerate(zip(umis, reads)):
+            key = (umi, read.reference_name, read.reference_start, read.reference_end)
+            buckets.setdefault(key, []).append(i)
+
+        if len(buckets) == 1:
+            return [reads]
+
+        # Compute the distance matrix based on the UMI distance and genomic coordinates
+        distance_matrix = self._generate_matrix(list(buckets), threshold, window)
 
         if not distance_matrix.any():
             logger.warning("Empty distance matrix. Skipping clustering.")
-            return reads
+            return [[read] for read in reads]
 
         # Perform hierarchical clustering with complete linkage and threshold = max umi distance + allowed window
         linkage_matrix = linkage(distance_matrix, method='complete')
@@ -87,85 +105,70 @@ class Clusterer:
             logger.warning("No clusters found. Skipping clustering.")
             return []
 
-        # Fetch the reads associated with each cluster
-        grouped_reads = []
-        for c in np.unique(clusters):
-            assoc_reads: List = self._fetch_by_cluster_idx(reads, clusters, c)
-            grouped_reads.append(assoc_reads)
-
-            if not assoc_reads:
-                logger.warning(f"No reads found for cluster {c}.")
+        # Expand the cluster of each unique key to its reads
+        labels = np.empty(len(reads), dtype=clusters.dtype)
+        for label, idx in zip(clusters, buckets.values()):
+            labels[idx] = label
 
+        # Fetch the reads associated with each cluster
+        _, grouped_reads = group_by_label(reads, labels)
         return grouped_reads
 
-    def _generate_matrix(self, reads: List[AlignedSegment], threshold: int = 1, window: int = 5) -> np.ndarray:
-        """Generates a similarity matrix for the reads in the target region.
-
-        Args:
-            reads (List[AlignedSegment]): list of reads in the target region.
-
-        Returns:
-            np.array: similarity matrix.
-        """
-        read_keys = [
-            (
-                read.query_name.split("_")[-1],
-                read.reference_name,
-                read.reference_start,
-                read.reference_end
-            ) for read in reads
-        ]
-        return pdist(read_keys, lambda x, y: self._metric(x, y, threshold, window))
-
-    @staticmethod
-    def _fetch_by_cluster_idx(reads: List, clusters: np.array, idx: int) -> List[AlignedSegment]:
-        reads = np.array(reads)
-        return reads[clusters == idx].tolist()
-
-    @staticmethod
-    def _metric(x: tuple, y: tuple, threshold: int = 1, window: int = 5) -> int:
-        """Custom metric to compute the similarity between two reads.
+    def _generate_matrix(self, keys: List[Tuple], threshold: int = 1, window: int = 5) -> np.ndarray:
+        """Generates a condensed distance matrix for the reads in the target region.
         - If the UMI distance is greater than the threshold, the reads are not considered to be from the same origin.
-        - The same applies to coordinate distance: if dist > window, the similarity score is 999.
+        - The same applies to reads in different chromosomes or with a coordinate distance greater than the window.
+        In these cases the distance is set to 999, otherwise it is the UMI distance plus the coordinate distance.
 
         Args:
-            x (tuple): tuple containing the UMI, chr, start and end coordinate of first read.
-            y (tuple): tuple containing the UMI, chr, start and end coordinate of second read.
+            keys (List[Tuple]): (UMI, chromosome, start, end) of each read in the target region.
             threshold (int, optional): maximum UMI distance to consider same cluster. Defaults to 1.
             window (int, optional): window size to consider for the coordinates. Defaults to 5.
 
         Returns:
-            int: similarity score.
+            np.array: condensed float64 distance matrix, as expected by linkage (which would copy any other dtype).
         """
-        umi_dist = hamming(list(x[0]), list(y[0])) * len(x[0])  # Hamming distance (0-1) * length of UMI
-
-        if umi_dist > threshold:
-            return 999
-
-        if x[1] != y[1]:  # Different chromosome
-            return 999
-
-        cdist = (abs(int(x[2]) - int(y[2])) + abs(int(x[3]) - int(y[3])))/2
-        coord_dist = cdist if cdist <= window else 999
-
-        return umi_dist + coord_dist
-
-    @staticmethod
-    def _split_bam(bam: str) -> List[List[AlignedSegment]]:
-        """Fetches the reads from each chromosome in the bam file to a separate list.
+        n = len(keys)
+        umis, chroms, starts, ends = zip(*keys)
+        _, chroms = np.unique(chroms, return_inverse=True)
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+
+        if NUMBA_AVAILABLE:
+            umis = encode_umis(umis)
+            distances = np.empty(n * (n - 1) // 2, dtype=np.float64)
+            pairwise_umi_coord(umis, starts, ends, chroms, threshold, window, distances)
+            return distances
+
+        umis = pack_umis(umis)
+
+        # fill the condensed matrix row by row, comparing read i against reads i+1..n
+        distances = np.empty(n * (n - 1) // 2, dtype=np.float64)
+        offset = 0
+        for i in range(n - 1):
+            umi_dist = umi_distances(umis[i + 1 :], umis[i])
+            coord_dist = (np.abs(starts[i + 1 :] - starts[i]) + np.abs(ends[i + 1 :] - ends[i])) / 2
+            same_origin = (umi_dist <= threshold) & (chroms[i + 1 :] == chroms[i]) & (coord_dist <= window)
+
+            distances[offset : offset + n - i - 1] = np.where(same_origin, umi_dist + coord_dist, 999)
+            offset += n - i - 1
+
+        return distances
+
+    def _split_bam(self, bamfile: AlignmentFile) -> List[List[AlignedSegment]]:
+        """Fetches the reads from each chromosome in the (already open) bam file to a separate list.
         This allows for multiprocessing without running the risk of splitting a cluster into multiple processes,
         thus artificially increasing the number of clusters."""
-
-        with AlignmentFile(bam, "rb") as bamfile:
-            contigs = bamfile.references
-            logger.info(f"Found {len(contigs)} contigs.")
-            logger.info(f"Found {bamfile.mapped} mapped reads in {bam}.")
-            logger.info("Splitting bam file by contig...")
-
-            bam_reads = []
-            for contig in contigs:
-                reads = [read for read in bamfile.fetch(contig=contig) if not read.is_unmapped]
-                if reads:
-                    bam_reads.append(reads)
-            logger.info(f"Found {len(bam_reads)} mapped contigs.")                
+        contigs = bamfile.references
+        logger.info(f"Found {len(contigs)} contigs.")
+        logger.info(f"Found {bamfile.mapped} mapped reads in {self.bam}.")
+        logger.info("Splitting bam file by contig...")
+
+        # a single pass over the file, the reads being split by their reference id (kept in the contig order)
+        by_contig: Dict[int, List[AlignedSegment]] = dict()
+        for read in bamfile.fetch(until_eof=True):
+            if not read.is_unmapped:
+                by_contig.setdefault(read.reference_id, []).append(read)
+        bam_reads = [by_contig[ref_id] for ref_id in sorted(by_contig)]
+        logger.info(f"Found {len(bam_reads)} mapped contigs.")
         return bam_reads
\ No newline at end of file
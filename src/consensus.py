@@ -1,19 +1,51 @@
 import logging
+import string
 from typing import List, Tuple, TypeVar
 
 import numpy as np
 
-from .utils import CustomAlignedSegment, ConsensusRead, EmptyClusterError
+try:
+    import parasail
+except ImportError:
+    parasail = None
+
+from ._align_numba import nw_fill
+from .utils import CustomAlignedSegment, ConsensusRead, EmptyClusterError, DELETION
 
 
 logger = logging.getLogger(__name__)
 AlignedSegment = TypeVar("AlignedSegment")
 
+PARASAIL_AVAILABLE = parasail is not None
+
+# quality score -> score tier used to weight the bases of a column (>= 30: 8, >= 20: 6, >= 15: 4, else 2)
+_QSCORE_LUT = np.array([2] * 15 + [4] * 5 + [6] * 10 + [8] * (256 - 30), dtype=np.int8)
+
+# parasail is case-insensitive, so lowercase insertions are mapped to other symbols
+_PARASAIL_SYMBOLS = "0123456789!#$%&()+,./:;<=>"
+_TO_PARASAIL = str.maketrans(string.ascii_lowercase, _PARASAIL_SYMBOLS)
+
+
+def _build_parasail_matrix():
+    """Builds parasail's substitution matrix with the same scoring as nw_fill: identical symbols (or any
+    symbol against a 'p' deletion) score 1, others 0."""
+    alphabet = string.ascii_uppercase + _PARASAIL_SYMBOLS
+    matrix = parasail.matrix_create(alphabet, 1, 0)
+    deletion = alphabet.index("p".translate(_TO_PARASAIL))
+    for i in range(matrix.size):
+        matrix[deletion, i] = 1
+        matrix[i, deletion] = 1
+    return matrix
+
+
+_PARASAIL_MATRIX = _build_parasail_matrix() if PARASAIL_AVAILABLE else None
+
 
 class Consensus:
-    def __init__(self, reads: List[AlignedSegment]) -> None:
+    def __init__(self, reads: List[AlignedSegment], use_parasail: bool = False) -> None:
         # convert the reads to CustomAlignedSegment objects and sort them by their length
         self.reads = [CustomAlignedSegment(read) for read in reads]
+        self.use_parasail = use_parasail  # align with parasail instead of nw_fill (see _align_strings)
 
     def compute_consensus(self) -> ConsensusRead:
         """Computes the consensus read for a cluster.
@@ -22,13 +54,14 @@ class Consensus:
             CustomAlignedSegment: An object containing the consensus sequence, quality string and read_id.
         """
         if len(self.reads) == 1:
-            return ConsensusRead(self.reads[0].seq, self.reads[0].int_qual, self.reads[0].id)
+            read = self.reads[0]
+            return ConsensusRead(read.seq_arr.tobytes().decode("ascii"), read.qual_arr, read.id)
 
-        # pad the sequences to account for indels
-        [read.seq_pad() for read in self.reads]
+        # pad the sequences and qualities to account for indels
+        CustomAlignedSegment.pad_all(self.reads)
 
         # sort the reads by their sequence length
-        self.reads = sorted(self.reads, key=lambda x: len(x.seq), reverse=True)
+        self.reads = sorted(self.reads, key=lambda x: len(x.seq_arr), reverse=True)
         try:
             seq, qual = self._consensus()
         except Exception as e:
@@ -37,59 +70,59 @@ class Consensus:
 
         return ConsensusRead(seq, qual, self.reads[0].id)
 
-    def _consensus(self) -> Tuple[str, List[int]]:
+    def _consensus(self) -> Tuple[str, np.ndarray]:
         """
         Takes a list of AlignedSegment objects and computes their consensus sequence.
 
         Returns:
-            Tuple[str, List[int]]: A tuple containing the consensus sequence and quality string.
+            Tuple[str, np.ndarray]: A tuple containing the consensus sequence and quality scores.
         """
 
         # Align the reads with the longest read using the Needleman-Wunsch algorithm to account for insertions
-        self.reads = self._align_strings(self.reads)
-
-        # Format the quality strings to match their sequences
-        [read.qual_pad() for read in self.reads]
-
-        # Find the consensus sequence
-        consensus = ""
-        quality = []
-
-        for bases, qualities in zip(zip(*[r.seq for r in self.reads]), zip(*[r.int_qual for r in self.reads])):
-            # for each A, T, G, C, and p in the column, count the number of times it appears
-            counts = {base: bases.count(base) / len(bases) for base in set(bases)}
-            n_scores = {key: value * 10 for key, value in counts.items()}
-
-            # for each A, T, G, C, and p in the column, get the mean quality score for this position
-            q_scores = {base: 0 for base in set(bases)}
-            for i, base in enumerate(bases):
-                if base != "p":
-                    q_scores[base] += qualities[i]
-
-            get_q_score = lambda base: q_scores[base] / (counts[base] * len(bases))
-            qual_per_base: dict = {b: get_q_score(b) for b in set(bases) if b != "p" and counts[b] != 0}
-
-            # !penalty: in case of tie, real base is taken. remove penalty if needed
-            try:
-                # deletions quality is the average quality of the other bases minos a penalty
-                qual_per_base["p"] = sum(qual_per_base.values()) / len(qual_per_base) - 5
-            except ZeroDivisionError:
-                # all bases are deletions, skip this position
-                continue
-
-            # assign a score to each base based on its quality
-            q_scores = self._assign_q_score(qual_per_base)
-
-            # combine the scores from the quantity and quality
-            scores = {base: 0.5 * n_scores[base] + 0.5 * q_scores[base] for base in n_scores.keys()}
-
-            # pick the base with the highest score
-            base = max(scores, key=scores.get)
-            consensus += base if base != "p" else ""
-
-            if base != "p":
-                # asign the quality of the selected base to the consensus
-                quality.append(int(qual_per_base[base]))
+        self.reads = self._align_strings(self.reads, self.use_parasail)
+
+        # Stack the aligned reads into a (reads x columns) matrix. Columns past the shortest read are dropped
+        length = min(len(read.seq_arr) for read in self.reads)
+        if length == 0:
+            return "", np.empty(0, dtype=np.uint8)
+        seq_mat = np.stack([read.seq_arr[:length] for read in self.reads])
+        qual_mat = np.stack([read.qual_arr[:length] for read in self.reads])
+        n_reads = len(self.reads)
+
+        # for each symbol (A, T, G, C, p, insertions...) in the alignment, count how many times it appears per column
+        # in a single bincount over (symbol, column) bins
+        symbols, inverse = np.unique(seq_mat, return_inverse=True)
+        bins = (inverse.reshape(seq_mat.shape) * length + np.arange(length)).ravel()
+        n_bins = len(symbols) * length
+        counts = np.bincount(bins, minlength=n_bins).reshape(-1, length) / n_reads
+        n_scores = counts * 10
+
+        # for each symbol, get the mean quality score per column
+        q_sums = np.bincount(bins, weights=qual_mat.ravel(), minlength=n_bins).reshape(-1, length)
+        present = counts > 0
+        qual_per_base = np.divide(q_sums, counts * n_reads, out=np.zeros_like(counts), where=present)
+
+        # !penalty: in case of tie, real base is taken. remove penalty if needed
+        # deletions quality is the average quality of the other bases minus a penalty
+        is_deletion = symbols == DELETION
+        bases_present = present & ~is_deletion[:, np.newaxis]
+        n_bases = bases_present.sum(axis=0)
+        qual_per_base[is_deletion] = (qual_per_base * bases_present).sum(axis=0) / np.maximum(n_bases, 1) - 5
+
+        # assign a score to each base based on its quality
+        q_scores = self._assign_q_score(qual_per_base)
+
+        # combine the scores from the quantity and quality
+        scores = np.where(present, 0.5 * n_scores + 0.5 * q_scores, -np.inf)
+
+        # pick the base with the highest score, skipping the positions where all bases are deletions
+        choice = scores.argmax(axis=0)
+        columns = np.arange(length)
+        keep = (n_bases > 0) & ~is_deletion[choice]
+
+        consensus = symbols[choice[keep]].tobytes().decode("ascii")
+        # asign the quality of the selected base to the consensus
+        quality = qual_per_base[choice[keep], columns[keep]].astype(np.uint8)
 
         if len(consensus) != len(quality):
             logger.error("Consensus and quality strings are not the same length.")
@@ -98,85 +131,86 @@ class Consensus:
         return consensus, quality
 
     @staticmethod
-    def _align_strings(reads: List[CustomAlignedSegment]) -> List[CustomAlignedSegment]:
-        # Set the gap penalty and the substitution matrix
+    def _align_strings(reads: List[CustomAlignedSegment], use_parasail: bool = False) -> List[CustomAlignedSegment]:
+        # Set the gap penalty
         gap_penalty = -1
-        substitution_matrix = np.zeros((256, 256), dtype=int)
-        # 'p' is a special character that represents a deletion and is treated as wildcard
-        for i in range(256):
-            substitution_matrix[i, i] = 1
-            substitution_matrix[i, ord("p")] = 1
-            substitution_matrix[ord("p"), i] = 1
 
         # Find the length of the longest string
-        max_length = max(len(r.seq) for r in reads)
+        max_length = max(len(r.seq_arr) for r in reads)
+        ref = reads[0].seq_arr
+
+        # Reads as long as the reference with at most one mismatch are already aligned: no gapped alignment
+        # can reach the n - 1 score of the identity, so the aligner would return it unchanged
+        to_align = [read for read in reads[1:] if not Consensus._is_aligned(read.seq_arr, ref)]
+        if not to_align:
+            return reads
+
+        # Use parasail's SIMD aligner if requested (scores are 16-bit, so it is limited to shorter reads, and it
+        # can't take empty sequences). Its alignments score the same as nw_fill's, but ties between equally good
+        # alignments may place the gaps differently, so it is opt-in to keep the output reproducible
+        if use_parasail and parasail is not None and max_length < 2**15 and all(len(r.seq_arr) for r in to_align):
+            Consensus._align_parasail([reads[0]] + to_align, -gap_penalty)
+            return reads
+
+        # Allocate the traceback matrix once for the whole cluster, no read is longer than the reference
+        traceback_buffer = np.empty((max_length + 1, max_length + 1), dtype=np.int8)
 
         # Align each string with the longest string using the Needleman-Wunsch algorithm
-        for i in range(len(reads)):
-            # Initialize the scoring matrix and the traceback matrix
-            rows = len(reads[i].seq) + 1
+        for read in to_align:
+            # Fill in the scoring matrix and get the traceback matrix
+            rows = len(read.seq_arr) + 1
             cols = max_length + 1
-            score_matrix = np.zeros((rows, cols), dtype=int)
-            traceback_matrix = np.zeros((rows, cols), dtype=int)
-
-            # Fill in the scoring matrix
-            for r in range(1, rows):
-                for c in range(1, cols):
-                    if reads[i].seq[r - 1] == "p" or reads[0].seq[c - 1] == "p":
-                        match_score = 1
-                    else:
-                        match_score = substitution_matrix[
-                            ord(reads[i].seq[r - 1]), ord(reads[0].seq[c - 1])
-                        ]
-                    diagonal_score = score_matrix[r - 1, c - 1] + match_score
-                    up_score = score_matrix[r - 1, c] + gap_penalty
-                    left_score = score_matrix[r, c - 1] + gap_penalty
-                    score = max(diagonal_score, up_score, left_score)
-                    score_matrix[r, c] = score
-
-                    if score == diagonal_score:
-                        traceback_matrix[r, c] = 1
-                    elif score == up_score:
-                        traceback_matrix[r, c] = 2
-                    else:
-                        traceback_matrix[r, c] = 3
-
-            # Trace back the alignment from the bottom-right corner of the matrix
-            aligned_i = ""
-            aligned_j = ""
+            query = read.seq_arr
+            traceback_matrix = nw_fill(query, ref, gap_penalty, traceback_buffer)
+
+            # Trace back the alignment from the bottom-right corner of the matrix, marking the gaps of the
+            # aligned read back to front in a buffer large enough for the longest possible alignment
+            gaps = bytearray(rows + cols - 2)
+            k = len(gaps)
             r = rows - 1
             c = cols - 1
 
             while r > 0 or c > 0:
+                k -= 1
                 if traceback_matrix[r, c] == 1:
-                    aligned_i = reads[i].seq[r - 1] + aligned_i
-                    aligned_j = reads[0].seq[c - 1] + aligned_j
                     r -= 1
                     c -= 1
                 elif traceback_matrix[r, c] == 2:
-                    aligned_i = reads[i].seq[r - 1] + aligned_i
-                    aligned_j = "p" + aligned_j
                     r -= 1
                 else:
-                    aligned_i = "p" + aligned_i
-                    aligned_j = reads[0].seq[c - 1] + aligned_j
+                    gaps[k] = 1
                     c -= 1
 
-            # Add the aligned string to the output
-            reads[i].seq = aligned_i
+            # Pad the read (and its qualities) with the gaps of the alignment
+            read.insert_gaps(np.frombuffer(gaps[k:], dtype=np.bool_))
+
+        return reads
+
+    @staticmethod
+    def _is_aligned(seq: np.ndarray, ref: np.ndarray) -> bool:
+        """Checks if seq has the length of ref and at most one mismatch against it ('p' matches any base)."""
+        if len(seq) != len(ref):
+            return False
+        mismatches = (seq != ref) & (seq != DELETION) & (ref != DELETION)
+        return np.count_nonzero(mismatches) <= 1
+
+    @staticmethod
+    def _align_parasail(reads: List[CustomAlignedSegment], gap_penalty: int) -> List[CustomAlignedSegment]:
+        """Aligns each read with the longest one (reads[0]) using parasail's striped SIMD implementation.
+        Leading gaps are free on both sequences, as in the Needleman-Wunsch matrix of nw_fill."""
+        ref = reads[0].seq_arr.tobytes().decode("ascii")
+        profile = parasail.profile_create_16(ref.translate(_TO_PARASAIL), _PARASAIL_MATRIX)
+
+        for read in reads[1:]:
+            seq = read.seq_arr.tobytes().decode("ascii").translate(_TO_PARASAIL)
+            result = parasail.sg_qb_db_trace_scan_profile_16(profile, seq, gap_penalty, gap_penalty)
+            # the reference is parasail's query, so the aligned read is the traceback's "ref"
+            aligned = np.frombuffer(result.traceback.ref.encode("ascii"), dtype=np.uint8)
+            read.insert_gaps(aligned == ord("-"))
 
         return reads
 
     @staticmethod
-    def _assign_q_score(q_score: dict) -> dict:
-        r = {}
-        for key, value in q_score.items():
-            if value >= 30:
-                r[key] = 8
-            elif value >= 20:
-                r[key] = 6
-            elif value >= 15:
-                r[key] = 4
-            else:
-                r[key] = 2
-        return r
+    def _assign_q_score(q_score: np.ndarray) -> np.ndarray:
+        # the tiers start at integer qualities, so truncating the mean qualities does not change them
+        return _QSCORE_LUT[np.clip(q_score, 0, 255).astype(np.intp)]
@@ -3,18 +3,32 @@
 import logging
 import logging.config
 import multiprocessing
+import multiprocessing.pool
+import sys
+from collections import deque
+from itertools import islice
 from time import perf_counter as time
-from typing import TypeVar, List
+from typing import Iterable, Iterator, TypeVar, List, Optional
 
 from pysam import AlignedSegment
 
 from .clusterer import Clusterer
-from .consensus import Consensus
-from .utils import LogMessages, EmptyClusterError, PickableRead, group_reads
+from .consensus import Consensus, PARASAIL_AVAILABLE
+from ._numba import set_num_threads
+from .utils import LogMessages, EmptyClusterError, MP_CONTEXT, PickableRead, group_reads
 
 ConsensusRead = TypeVar("ConsensusRead")
 
-def main(bam: str, threads: int, threshold: int, window: int, debug: bool):
+def main(
+    bam: str,
+    threads: int,
+    threshold: int,
+    window: int,
+    debug: bool,
+    bam_threads: int = 1,
+    umi_length: Optional[int] = None,
+    use_parasail: bool = False,
+):
     """
     Takes the path to a UMI tagged BAM file, parses the reads
     and clusters them based on their UMI's similarity and genomic
@@ -35,7 +49,7 @@ def main(bam: str, threads: int, threshold: int, window: int, debug: bool):
             f"Invalid number of threads. Setting threads to {threads}."
         )
 
-    uc = Clusterer(bam)
+    uc = Clusterer(bam, bam_threads=bam_threads, umi_length=umi_length)
     bam_reads: List[List[AlignedSegment]] = uc.read_bam(threads=threads)
 
     if threads > 1:
@@ -49,23 +63,27 @@ def main(bam: str, threads: int, threshold: int, window: int, debug: bool):
 
     # create an object to hold relevant data from each read and still be pickable
     if threads > 1:
-        pk_reads = list()
-        for contig in bam_reads:
-            pk_reads.append([PickableRead(read) for read in contig])
+        pk_reads = [[PickableRead(read) for read in contig] for contig in bam_reads]
 
     # cluster the reads
     if threads > 1:
-        with multiprocessing.Pool(processes=threads) as pool:
-            # Apply the process_element function to each element in the list
-            pk_clustered_reads = pool.map(uc.cluster, pk_reads)
+        # the largest contigs are sent first and one at a time, so that they do not end up as the tail of the
+        # pool. The results are put back in the contig order
+        order = sorted(range(len(pk_reads)), key=lambda i: len(pk_reads[i]), reverse=True)
+        with MP_CONTEXT.Pool(processes=threads, initializer=_init_worker) as pool:
+            results = pool.map(uc.cluster, [pk_reads[i] for i in order], chunksize=1)
+        pk_clustered_reads = [None] * len(order)
+        for i, contig_clusters in zip(order, results):
+            pk_clustered_reads[i] = contig_clusters
+        del results
+        del pk_reads
     else:
         clustered_reads: List[List[AlignedSegment]] = uc.cluster(bam_reads)
 
-    # trace back the original reads if using threading
+    # trace back the original reads if using threading (group_reads empties both lists as it goes)
     if threads > 1:
         clustered_reads = group_reads(pk_clustered_reads, bam_reads)
         del pk_clustered_reads
-        del pk_reads
         del bam_reads
     else:
         del bam_reads
@@ -74,51 +92,98 @@ def main(bam: str, threads: int, threshold: int, window: int, debug: bool):
     logger.info(f"{len(clustered_reads)} clusters found out of {total_reads} reads.")
 
     # check integrity of the clustering
-    def count_objects(nested_list, obj_type):
-        count = 0
-        if isinstance(nested_list, obj_type):
-            count += 1
-        elif isinstance(nested_list, list):
-            for sublist in nested_list:
-                count += count_objects(sublist, obj_type)
-        return count
-
     logger.info("Checking integrity of the clustering...")
+    clustered_total = sum(len(cluster) for cluster in clustered_reads)
 
     try:
-        assert total_reads == count_objects(clustered_reads, AlignedSegment)
+        assert total_reads == clustered_total
     except AssertionError:
         logger.error("Some reads were duplicated during the clustering process.")
         logger.error(f"Total reads: {total_reads}")
-        logger.error(f"Clustered reads: {count_objects(clustered_reads, AlignedSegment)}")
+        logger.error(f"Clustered reads: {clustered_total}")
         raise AssertionError
     logger.info(f"Clustering integrity check passed.\n{'-' * 50}")
 
     # ------------------ Consensus sequences ------------------
     logger.info("Starting consensus sequence computing...")
+    if use_parasail and not PARASAIL_AVAILABLE:
+        logger.warning("parasail is not installed. Aligning the reads with the Needleman-Wunsch implementation.")
+        use_parasail = False
 
     t = time()
 
-    consensus_reads = list()
-    errors = 0
-    for reads in clustered_reads:
-        try:
-            cs = Consensus(reads)
-        except EmptyClusterError:
-            errors += 1
-            continue
-        consensus_reads.append(cs.compute_consensus())
-
-    logger.info(f"Consensus sequences computed in {(time() - t):2f}s.\n{'-' * 50}")
-    logger.info(f"{errors} clusters were empty.")
+    # wrap the reads in the parent process, as pysam's AlignedSegments can't be pickled. The clusters are
+    # wrapped lazily, so that only the ones being computed are held as Consensus objects
+    empty_clusters: List[List[AlignedSegment]] = list()
+    clusters = _wrap_clusters(clustered_reads, empty_clusters, use_parasail)
 
-    # ------------------ Exporting ------------------
+    # the consensus reads are exported to STDOUT as they are computed, instead of being held until the end
     logger.info("Exporting consensus sequences to STDOUT...")
-    print(*consensus_reads, sep="\n")
+    if threads > 1:
+        with MP_CONTEXT.Pool(processes=threads, initializer=_init_worker) as pool:
+            _write_reads(_pool_consensus(pool, clusters, threads))
+    else:
+        _write_reads(cs.compute_consensus() for cs in clusters)
+
+    logger.info(f"Consensus sequences computed in {(time() - t):2f}s.\n{'-' * 50}")
+    logger.info(f"{len(empty_clusters)} clusters were empty.")
 
     # ------------------ END ------------------
     logger.info(f"Execution competed in {(time() - ti):2f}s.")
 
 
+def _write_reads(consensus_reads: Iterable[ConsensusRead], batch_size: int = 4096) -> None:
+    # the FASTQ records are written in batches to the binary STDOUT, so that the output is never built in
+    # memory while each write still carries thousands of records
+    out = sys.stdout.buffer
+    consensus_reads = iter(consensus_reads)
+    while batch := list(islice(consensus_reads, batch_size)):
+        out.write(b"".join(read.to_fastq_bytes() for read in batch))
+    out.flush()
+
+
+def _wrap_clusters(
+    clustered_reads: List[List[AlignedSegment]], empty_clusters: List[List[AlignedSegment]], use_parasail: bool
+) -> Iterator[Consensus]:
+    # the clusters are popped in order, so that the list is emptied as they are wrapped. Those that can't
+    # be wrapped are moved to empty_clusters
+    clustered_reads.reverse()
+    while clustered_reads:
+        reads = clustered_reads.pop()
+        try:
+            cs = Consensus(reads, use_parasail)
+        except EmptyClusterError:
+            empty_clusters.append(reads)
+            continue
+        yield cs
+
+
+def _pool_consensus(
+    pool: multiprocessing.pool.Pool, clusters: Iterator[Consensus], threads: int, batch_size: int = 4096
+) -> Iterator[ConsensusRead]:
+    # imap would consume the whole generator up front, so at most batch_size clusters are kept in flight, split in
+    # ~4 chunks per worker (balancing the uneven cluster sizes against the IPC overhead of small chunks). A new
+    # chunk is sent as soon as the oldest one is collected, so the workers never wait on a batch boundary
+    chunksize = max(1, batch_size // (threads * 4))
+    pending = deque()
+    while True:
+        while len(pending) < threads * 4 and (chunk := list(islice(clusters, chunksize))):
+            pending.append(pool.map_async(_compute_consensus, chunk, chunksize=len(chunk)))
+        if not pending:
+            return
+        yield from pending.popleft().get()
+
+
+def _init_worker() -> None:
+    # the pool already runs one process per thread, so numba's parallel kernels run serially in each worker
+    # instead of starting their own threads on top (threads x NUMBA_NUM_THREADS)
+    set_num_threads(1)
+
+
+def _compute_consensus(cs: Consensus) -> ConsensusRead:
+    # module-level so that it can be sent to the pool workers
+    return cs.compute_consensus()
+
+
 if __name__ == "__main__":
     main()
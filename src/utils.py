@@ -1,44 +1,75 @@
 import os
 import sys
 import logging
-from typing import List, Tuple, TypeVar
+import multiprocessing
+from itertools import chain
+from operator import attrgetter
+from typing import Dict, List, Optional, Tuple, TypeVar
 
+import numpy as np
 import pysam
 
+from ._cigar import DELETION, QUAL_DELETION, LOWERCASE, apply_cigars
+from ._numba import NUMBA_AVAILABLE
+
 AlignedSegment = TypeVar("AlignedSegment")
 logger = logging.getLogger(__name__)
 
+# UMIs are packed as their raw bytes, 8 bases per uint64 word, so that every symbol (IUPAC codes, lowercase
+# bases...) stays distinct, as in the byte comparison of the numba kernel
+_BASES_PER_WORD = 8
+_BASE_SHIFTS = np.arange(_BASES_PER_WORD, dtype=np.uint64) * np.uint64(8)
+_BASE_MASK = np.uint64(0x0101010101010101)  # lowest bit of each byte
+
+# fork the pool workers on Linux, so that they inherit the imported modules (pysam, numba's compiled kernels)
+# instead of importing them again, as newer Python versions no longer fork by default
+MP_CONTEXT = multiprocessing.get_context("fork" if sys.platform == "linux" else None)
+
+# Q score -> Phred+33 ASCII character (capped at '~')
+_PHRED_ADD33 = bytes(min(q + 33, 126) for q in range(256))
+
+# the attributes identifying a read (see PickableRead._id), fetched from pysam in a single call
+_read_id = attrgetter("query_name", "reference_name", "reference_start", "reference_end")
+
+
+# logging setup shared by every run, only the log file (in the working directory at the time the logging is
+# configured) and the level of the root logger are set by get_config
+_BASE_CONFIG = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "default": {
+            "format": "%(asctime)s - %(levelname)s(%(name)s): %(message)s",
+            "datefmt": "%d/%m/%Y %H:%M:%S",
+        }
+    },
+}
+_FILE_HANDLER = {
+    "class": "logging.FileHandler",
+    "mode": "w",
+    "encoding": "utf-8",
+    "formatter": "default",
+}
+
 
 class LogMessages:
     @staticmethod
     def init_log(bam: str, regions: list):
-        r = f"Initializing UMIclusterer.\n"
-        r += f"Python version: {sys.version}\n"
-        r += f"Pysam version: {pysam.__version__}\n\n"
-        r += f"Input bam: {bam}\n"
-        r += f"Target regions: {regions}\n"
-        r += f"{'-' * 50}\n"
-        return r
+        return (
+            f"Initializing UMIclusterer.\n"
+            f"Python version: {sys.version}\n"
+            f"Pysam version: {pysam.__version__}\n\n"
+            f"Input bam: {bam}\n"
+            f"Target regions: {regions}\n"
+            f"{'-' * 50}\n"
+        )
 
     @staticmethod
     def get_config(debug: bool):
         return {
-            "version": 1,
-            "disable_existing_loggers": False,
-            "formatters": {
-                "default": {
-                    "format": "%(asctime)s - %(levelname)s(%(name)s): %(message)s",
-                    "datefmt": "%d/%m/%Y %H:%M:%S",
-                }
-            },
+            **_BASE_CONFIG,
             "handlers": {
-                "file": {
-                    "class": "logging.FileHandler",
-                    "filename": os.path.join(os.getcwd(), "UMIClusterer.log"),
-                    "mode": "w",
-                    "encoding": "utf-8",
-                    "formatter": "default",
-                }
+                "file": {**_FILE_HANDLER, "filename": os.path.join(os.getcwd(), "UMIClusterer.log")},
             },
             "loggers": {
                 "": {
@@ -54,136 +85,264 @@ class EmptyClusterError(Exception):
 
 
 class CustomAlignedSegment:
+    # no per-instance __dict__, as there is one of these for each read of the clusters
+    __slots__ = ("seq_arr", "qual_arr", "id", "cigar_ops", "cigar_lens")
+
     def __init__(self, read: AlignedSegment):
-        if not isinstance(read, pysam.libcalignedsegment.AlignedSegment):
+        # pysam only yields AlignedSegments, so the check is skipped when running with python -O
+        if __debug__ and not isinstance(read, pysam.libcalignedsegment.AlignedSegment):
             raise EmptyClusterError("Read is not an AlignedSegment object.")
-        
-        self.seq: str = read.query_sequence
-        self.int_qual: List[int] = list(read.query_qualities)  # Q scores as integers, not ASCII values (base 33)
 
-        self.id: str = read.query_name
-        self.cigar: Tuple[Tuple[int, int]] = read.cigartuples
+        # bases as ASCII codes and Q scores as integers (not ASCII values, base 33). The qualities are a
+        # view of the array.array returned by pysam, which is a fresh copy for each access
+        self.seq_arr: np.ndarray = np.frombuffer(read.query_sequence.encode("ascii"), dtype=np.uint8)
+        self.qual_arr: np.ndarray = np.frombuffer(read.query_qualities, dtype=np.int8)
 
-        self.__seq_padded = False
-        self.__qual_padded = False
+        self.id: str = read.query_name
+        # the CIGAR operations and their lengths, as two contiguous int32 arrays
+        cigar = np.array(_normalize_cigar(read.cigartuples or ()), dtype=np.int32).reshape(-1, 2)
+        self.cigar_ops: np.ndarray = np.ascontiguousarray(cigar[:, 0])
+        self.cigar_lens: np.ndarray = np.ascontiguousarray(cigar[:, 1])
 
-    def seq_pad(self) -> None:
+    def pad(self) -> None:
         """
-        Takes a read and its cigar and formats the read accordingly:
+        Takes a read and its cigar and formats the sequence and quality arrays accordingly, in a single pass:
             - Matches and mismatches are left as is.
-            - Insertions are converted to lowecase.
-            - Deletions are padded with 'p'.
+            - Insertions are converted to lowecase, their qualities are left as is.
+            - Deletions are padded with 'p' in the sequence and QUAL_DELETION in the qualities.
         """
-        if not self.__seq_padded:
-            self.__seq_padded = True
-            pos = 0
-            _seq = ""
-
-            for op, length in self.cigar:
-                if op == 0:  # match or mismatch
-                    _seq += self.seq[pos : pos + length]
-                    pos += length
-                elif op == 1:  # insertion
-                    _seq += self.seq[pos : pos + length].lower()
-                    pos += length
-                elif op == 2:  # deletion
-                    _seq += "p" * length
-                elif op == 3:  # skipped region
-                    continue
-                elif op == 4:  # soft clipping
-                    continue
-                elif op == 5:  # hard clipping
-                    continue
-            self.seq = _seq
-
-    def qual_pad(self) -> None:
+        size = int(self.cigar_lens.sum())
+
+        # the buffers start filled with deletions, so these only need to advance the output position
+        _seq = bytearray(b"p") * size
+        _qual = bytearray(np.int8(QUAL_DELETION).tobytes()) * size
+        seq = memoryview(self.seq_arr)
+        qual = memoryview(self.qual_arr)
+        pos = 0
+        out = 0
+
+        for op, length in zip(self.cigar_ops.tolist(), self.cigar_lens.tolist()):
+            if op == 0:  # match or mismatch
+                _seq[out : out + length] = seq[pos : pos + length]
+                _qual[out : out + length] = qual[pos : pos + length]
+                pos += length
+            elif op == 1:  # insertion
+                _seq[out : out + length] = seq[pos : pos + length].tobytes().translate(LOWERCASE)
+                _qual[out : out + length] = qual[pos : pos + length]
+                pos += length
+            out += length
+
+        self.seq_arr = np.frombuffer(_seq, dtype=np.uint8)
+        self.qual_arr = np.frombuffer(_qual, dtype=np.int8)
+
+    @staticmethod
+    def pad_all(reads: List["CustomAlignedSegment"]) -> None:
         """
-        Takes a quality string and a read and pads the quality string accordingly:
-            - Matches and mismatches are left as is.
-            - Insertions left as is.
-            - Deletions are padded with 'p'.
+        Pads a list of reads (see pad). With numba, the reads are packed one after the other and padded in a
+        single call, the padded arrays of each read being views of the packed result.
+        """
+        if not NUMBA_AVAILABLE:
+            [read.pad() for read in reads]
+            return
+
+        n_ops = [len(read.cigar_ops) for read in reads]
+        ops = np.concatenate([read.cigar_ops for read in reads])
+        lens = np.concatenate([read.cigar_lens for read in reads])
+        cigar_offsets = _offsets(n_ops)
+        offsets = _offsets([len(read.seq_arr) for read in reads])
+
+        padded_lengths = np.bincount(np.repeat(np.arange(len(reads)), n_ops), lens, len(reads))
+        out_offsets = _offsets(padded_lengths.astype(np.int64))
+
+        seqs = np.concatenate([read.seq_arr for read in reads])
+        quals = np.concatenate([read.qual_arr for read in reads])
+        out_seqs = np.empty(out_offsets[-1], dtype=np.uint8)
+        out_quals = np.empty(out_offsets[-1], dtype=np.int8)
+        apply_cigars(ops, lens, cigar_offsets, seqs, quals, offsets, out_seqs, out_quals, out_offsets)
+
+        for read, start, end in zip(reads, out_offsets[:-1], out_offsets[1:]):
+            read.seq_arr = out_seqs[start:end]
+            read.qual_arr = out_quals[start:end]
+
+    def insert_gaps(self, gaps: np.ndarray) -> None:
+        """
+        Applies an alignment to the padded read. gaps is a boolean mask over the aligned read marking
+        the deletions opened by the aligner, the remaining positions hold the read's bases in order.
         """
-        if not self.__seq_padded:
-            raise Exception("Sequence must be padded before quality.")
-
-        if not self.__qual_padded:
-            self.__qual_padded = True
-            pos = 0
-            _int_qual = []
-
-            for char in self.seq:
-                if char == "p":
-                    _int_qual.append("p")
-                else:
-                    _int_qual.append(self.int_qual[pos])
-                    pos += 1
-            self.int_qual = _int_qual
+        bases = ~gaps
+
+        _seq = np.full(len(gaps), DELETION, dtype=np.uint8)
+        _seq[bases] = self.seq_arr
+        self.seq_arr = _seq
+
+        _qual = np.full(len(gaps), QUAL_DELETION, dtype=np.int8)
+        _qual[bases] = self.qual_arr
+        self.qual_arr = _qual
 
     def __str__(self):
-        return f"{self.id=} {self.seq=} {self.int_qual=}"
+        return f"{self.id=} {self.seq_arr.tobytes()=} {self.qual_arr.tolist()=}"
 
 
 class ConsensusRead:
-    def __init__(self, seq: str, qual: List[int], _id: str) -> None:
+    def __init__(self, seq: str, qual: np.ndarray, _id: str) -> None:
         self.seq: str = seq
-        self.q_score: str = "".join([str(q) for q in qual])
-        self.ascii_qual: str = "".join([chr(score + 33) for score in qual])
+        self.qual: np.ndarray = np.asarray(qual, dtype=np.uint8)
+        self.ascii_qual: str = self.qual.tobytes().translate(_PHRED_ADD33).decode("ascii")
         self.id: str = _id
 
     def __str__(self):
-        return f"@{self.id}\n{self.seq}\n+{self.q_score}\n{self.ascii_qual}"
+        return f"@{self.id}\n{self.seq}\n+\n{self.ascii_qual}"
+
+    def to_fastq_bytes(self) -> bytes:
+        """Returns the FASTQ record (with its trailing newline) encoded and ready to be written."""
+        return f"{self}\n".encode("ascii")
+
+
+def _normalize_cigar(cigar: List[Tuple[int, int]]) -> Tuple[Tuple[int, int]]:
+    """
+    Keeps only the operations that make it to the padded read (matches, insertions and deletions; skipped
+    regions and clippings are ignored), merging consecutive operations of the same type.
+    """
+    normalized = []
+    for op, length in cigar:
+        if op > 2:
+            continue
+        if normalized and normalized[-1][0] == op:
+            normalized[-1] = (op, normalized[-1][1] + length)
+        else:
+            normalized.append((op, length))
+    return tuple(normalized)
+
+
+def _offsets(lengths: List[int]) -> np.ndarray:
+    """Returns the (n + 1) offsets of n items of the given lengths stored one after the other."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def extract_umis(names: List[str], umi_length: Optional[int] = None) -> List[str]:
+    """
+    Extracts the UMI from each read name. If the UMI length is known it is sliced from the end of
+    the name, otherwise it is taken as the text after the last underscore.
+    """
+    if umi_length:
+        return [name[-umi_length:] for name in names]
+    return [name.rsplit("_", 1)[-1] for name in names]
+
+
+def encode_umis(umis: List[str]) -> np.ndarray:
+    """
+    Encodes equal-length UMIs as an (N, L) uint8 matrix of their ASCII codes. UMIs of different lengths
+    can't be split back from their joined bytes, so they raise a ValueError instead.
+    """
+    lengths = set(map(len, umis))
+    if len(lengths) > 1:
+        logger.error(f"UMIs of different lengths found: {sorted(lengths)}.")
+        raise ValueError(f"UMIs of different lengths found: {sorted(lengths)}. Use --umi-length to trim them.")
+    return np.frombuffer("".join(umis).encode("ascii"), dtype=np.uint8).reshape(len(umis), lengths.pop() if lengths else 0)
+
+
+def pack_umis(umis: List[str]) -> np.ndarray:
+    """
+    Packs equal-length UMIs into uint64 words, using a byte per base and 8 bases per word.
+    Returns an (N, W) array, W being the number of words needed to hold a single UMI.
+    """
+    encoded = encode_umis(umis)
+    n_words = -(-encoded.shape[1] // _BASES_PER_WORD)
+
+    codes = np.zeros((len(umis), n_words * _BASES_PER_WORD), dtype=np.uint64)
+    codes[:, : encoded.shape[1]] = encoded
+    codes = codes.reshape(len(umis), n_words, _BASES_PER_WORD) << _BASE_SHIFTS
+
+    return np.bitwise_or.reduce(codes, axis=2)
+
+
+def umi_distances(packed: np.ndarray, other: np.ndarray) -> np.ndarray:
+    """
+    Computes the Hamming distance between UMIs packed with pack_umis. Both arguments
+    are broadcast against each other, the last axis being the packed words.
+    """
+    diff = packed ^ other
+    # collapse each byte into its lowest bit, set if the bases differ
+    diff |= diff >> np.uint64(4)
+    diff |= diff >> np.uint64(2)
+    diff = (diff | (diff >> np.uint64(1))) & _BASE_MASK
+    return _popcount(diff).sum(axis=-1)
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(x)
+
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def group_by_label(items: List, labels: np.ndarray) -> Tuple[np.ndarray, List[List]]:
+    """
+    Groups the items by their label with a single stable argsort, instead of masking the
+    items once per label. Returns the sorted unique labels and the items of each of them.
+    """
+    order = np.argsort(labels, kind="stable")
+    unique, starts = np.unique(labels[order], return_index=True)
+    return unique, [[items[i] for i in idx] for idx in np.split(order, starts[1:])]
 
 
 class PickableRead:
+    __slots__ = ("query_name", "reference_name", "reference_start", "reference_end", "_id")
+
     def __init__(self, read: AlignedSegment) -> None:
-        self.query_name: str = read.query_name
-        self.reference_name: str = read.reference_name
-        self.reference_start: int = read.reference_start
-        self.reference_end: int = read.reference_end
-        self._id = (self.query_name, self.reference_name, self.reference_start, self.reference_end)
+        self._id: Tuple[str, str, int, int] = _read_id(read)
+        self.query_name, self.reference_name, self.reference_start, self.reference_end = self._id
+
+
+def _pop_flatten(nested: List[list]) -> list:
+    """Flattens a list of lists in order, emptying it as the flat list grows."""
+    nested.reverse()
+    flat = []
+    while nested:
+        flat.extend(nested.pop())
+    return flat
 
 
 def group_reads(ordered_reads: List[List[PickableRead]], original_reads: List[AlignedSegment]) -> List[List[AlignedSegment]]:
     """
     Groups the original reads into the same groups as the ordered reads, using their query_name as a key.
     It also flattens the list of lists of lists of reads into a list of lists of reads, removing the 
-    groping by contig, that is no longer needed.
+    groping by contig, that is no longer needed. Both input lists are emptied in the process.
     """
-    # flatten the first level of ordererd lists
-    _reads = []
-    for contig_reads in ordered_reads:
-        _reads.extend(contig_reads)
-    ordered_reads = _reads
-    del _reads
-
-    # flatten the first level of original lists
-    _reads = []
-    for contig_reads in original_reads:
-        _reads.extend(contig_reads)
-    original_reads = _reads
+    # flatten the first level of both lists, popping the contigs so that the nested and the flat lists are
+    # not held in memory at the same time (reversed first, so that the contigs are popped in order)
+    ordered_reads = _pop_flatten(ordered_reads)
+    original_reads = _pop_flatten(original_reads)
+
+    # index the position of the original reads by query_name, so that each cluster is gathered without
+    # scanning all the reads (positions are sorted back, so that the reads keep their original order).
+    # They are indexed by their ids (as in PickableRead._id) too, to resolve multimappers
+    by_name: Dict[str, List[int]] = dict()
+    by_id: Dict[Tuple[str, str, int, int], List[int]] = dict()
+    for i, read in enumerate(original_reads):
+        by_name.setdefault(read.query_name, []).append(i)
+        by_id.setdefault(_read_id(read), []).append(i)
 
     #####################################
-    infer_id = lambda read: (read.query_name, read.reference_name, read.reference_start, read.reference_end)
+    # the clusters are popped too, releasing each PickableRead once its cluster is gathered
+    ordered_reads.reverse()
     grouped_reads = []
-    for cluster in ordered_reads:
-
-        # get the ids of the reads in the cluster
-        try:
-            cluster_read_ids = {read.query_name for read in cluster}
-        except TypeError:
-            # cluster contains a single read
-            cluster_read_ids = {cluster.query_name}
-            cluster = [cluster]
+    while ordered_reads:
+        cluster = ordered_reads.pop()
 
-        # create a new cluster with matching query_names (multimappers will be duplicated)
-        new_cluster = [read for read in original_reads if read.query_name in cluster_read_ids]
+        # gather the reads with matching query_names (multimappers will be duplicated)
+        positions = list(chain.from_iterable(by_name.get(read.query_name, ()) for read in cluster))
 
-        # check the presence of multimappers, and ask the object for more info to resolve them
-        if isinstance(cluster, list) and len(cluster) != len(new_cluster):
-            # compare with ids (slower but definitive
-            cluster_read_ids = [read._id for read in cluster]
-            new_cluster = [read for read in new_cluster if infer_id(read) in cluster_read_ids]
+        # check the presence of multimappers, and use the ids of the reads to resolve them
+        if len(cluster) != len(positions):
+            positions = chain.from_iterable(by_id.get(_id, ()) for _id in {read._id for read in cluster})
 
+        new_cluster = [original_reads[i] for i in sorted(positions)]
         grouped_reads.append(new_cluster)
 
     return grouped_reads
@@ -1,19 +1,41 @@
 #!/usr/bin/env python3
 
+import cProfile
 import os
+import pstats
+import shutil
+import subprocess
 from time import perf_counter
 
+from click.testing import CliRunner
+
+from umiclusterer import main
+
+# the runs share this process, so the interpreter start-up and the imports (pysam, numba kernels) are paid once
+runner = CliRunner()
+
+
+def _run(args: list) -> bytes:
+    """
+    Runs UMIclusterer in-process with the given command line arguments and returns its STDOUT.
+    """
+    result = runner.invoke(main, args, catch_exceptions=False)
+    if result.exit_code != 0:
+        raise RuntimeError(f"UMIclusterer exited with code {result.exit_code}.")
+    return result.stdout_bytes
+
 
 def fast_test() -> None:
     """
     Run a quick test to check if the program is working.
     """
-    cmd = "python umiclusterer.py test_files/sample.bam -j 4 -t 1 -w 5 --debug > output/test_sample.fastq"
+    args = ["test_files/sample.bam", "-j", "4", "-t", "1", "-w", "5", "--debug"]
     print("Starting short test run in debug mode...")
-    print(f"Command: {cmd}", flush=True)
+    print(f"Command: umiclusterer.py {' '.join(args)} > output/test_sample.fastq", flush=True)
 
     start = perf_counter()
-    os.system(cmd)
+    with open("output/test_sample.fastq", "wb") as out:
+        out.write(_run(args))
     end = perf_counter()
 
     print(f"Time elapsed: {end - start:.2f} seconds", flush=True)
@@ -24,13 +46,17 @@ def full_test() -> None:
     Run a full test to check if the program is working.
     """
     bam = "test_files/full.bam"
-    cmd = f"python umiclusterer.py {bam} -j 10 -t 1 -w 5 --debug | gzip > output/test_full.fastq.gz"
+    args = [bam, "-j", "10", "-t", "1", "-w", "5", "--debug"]
+
+    # the output is compressed with pigz (parallel gzip) when available, as gzip is single-threaded
+    compress = ["pigz", "-p", str(os.cpu_count() or 1)] if shutil.which("pigz") else ["gzip"]
 
     print("Starting full test run in debug mode...")
-    print(f"Command: {cmd}", flush=True)
+    print(f"Command: umiclusterer.py {' '.join(args)} | {' '.join(compress)} > output/test_full.fastq.gz", flush=True)
 
     start = perf_counter()
-    os.system(cmd)
+    with open("output/test_full.fastq.gz", "wb") as out:
+        subprocess.run(compress, input=_run(args), stdout=out, check=True)
     end = perf_counter()
 
     print(f"Time elapsed: {end - start:.2f} seconds", flush=True)
@@ -38,12 +64,26 @@ def full_test() -> None:
 
 def profiling() -> None:
     """
-    Run a profiling test to check bottlenecks.
+    Run a profiling test to check bottlenecks. A single thread is used, as the pool workers are not profiled.
     """
-    ...
+    args = ["test_files/sample.bam", "-j", "1", "-t", "1", "-w", "5"]
+    print("Starting profiling run...")
+    print(f"Command: umiclusterer.py {' '.join(args)} > output/profile_sample.fastq", flush=True)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    stdout = _run(args)
+    profiler.disable()
+
+    with open("output/profile_sample.fastq", "wb") as out:
+        out.write(stdout)
+    profiler.dump_stats("output/profile.pstats")
+    pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(20)
+    print("Profile saved to output/profile.pstats", flush=True)
 
 
 if __name__ == "__main__":
     fast_test()
     full_test()
+    profiling()
     print("Test runs completed. Check the log file for more information.")
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+
 import click
 
 from src import UMIclusterer
@@ -19,6 +21,14 @@ from src import UMIclusterer
     required=False,
     default=1,
 )
+@click.option(
+    "--bam-threads",
+    "-b",
+    type=click.INT,
+    help="Threads to use to decompress the BAM file.",
+    required=False,
+    default=min(4, os.cpu_count() or 1),
+)
 @click.option(
     "--threshold",
     "-t",
@@ -35,6 +45,21 @@ from src import UMIclusterer
     required=False,
     default=5,
 )
+@click.option(
+    "--umi-length",
+    "-u",
+    type=click.INT,
+    help="Length of the UMI at the end of the read names. If not given, the UMI is taken after the last underscore.",
+    required=False,
+    default=None,
+)
+@click.option(
+    "--parasail",
+    is_flag=True,
+    help="Align the reads of each cluster with parasail's SIMD aligner (must be installed). Faster, but equally "
+    "good alignments may be resolved differently than with the default aligner.",
+    required=False,
+)
 @click.option(
     "--debug",
     "-d",
@@ -42,8 +67,10 @@ from src import UMIclusterer
     help="Enables debug mode.",
     required=False,
 )
-def main(bam, threads, threshold, window, debug):
-    UMIclusterer(bam, threads, threshold, window, debug)
+def main(bam, threads, bam_threads, threshold, window, umi_length, parasail, debug):
+    UMIclusterer(
+        bam, threads, threshold, window, debug, bam_threads=bam_threads, umi_length=umi_length, use_parasail=parasail
+    )
 
 
 if __name__ == "__main__":